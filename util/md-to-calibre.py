@@ -16,6 +16,10 @@ OPTIONS:
     -h, --help     Show this usage and options help message.
     -v, --verbose  Verbose mode to aid in debugging.
 
+CALIBREDB_DIR is the Calibre library directory containing metadata.db. The script writes to that 
+database directly, so Calibre and Calibre Web should not use the library while it runs. For speed, 
+it does so without crash protection, so make a backup of the library before running the script.
+
 INSTALLATION:
     1. Create and activate a virtual environment:
         python3 -m venv ./venv
@@ -28,23 +32,10 @@ INSTALLATION:
 """
 
 # TO-DO List
-# TODO: To speed the process up, use a direct SQLite connection or via an API. Because starting one 
-#   process for every database access (as currently with calibredb) is really slow. API candidates: 
-#   the official Calibre database API or better the SqlAlchemy based object-relational mapper used 
-#   inside Calibre Web.
-#   Example:
-#   import sqlite3
-#   db_connection = sqlite3.connect(args['CALIBREDB'])
-#   db_cursor = db_connection.cursor()
-#   db_cursor.executemany('INSERT INTO tablename VALUES (?,?,?,…)', booklist_dicts)
-#   db_connection.commit()
-#   db_connection.close()
 # TODO: Fix that Markdown lists are not yet converted to HTML. This might be because they do not 
 #   have a blank line above them, which has been corrected in the source files now but not yet 
 #   tested during importing. Affects three books: Autarky Library book IDs 28, 29, 244. So far, 
 #   the error has been fixed manually in the script output.
-# TODO: Fix that empty lines containing just space characters are not yet recognized as separating 
-#   literature entries. (Not important, as this has been fixed in the source file to import now.)
 # TODO: Allow "[" and "]" inside link text as long as they appear in matched pairs. Not important, 
 #   as these characters are no longer used in the current list to import ("Autarky Library").
 
@@ -53,171 +44,363 @@ INSTALLATION:
 import re
 import logging
 import sys
-import subprocess
+import os
+import sqlite3
+import unicodedata
+import uuid
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
+from itertools import repeat
 
 # Custom PyPi packages.
 from docopt import docopt
 import markdown
 
 
-def calibredb_title_args(dict):
+# Not setting the author would default to "Unknown", but we want "Unknown Author".
+AUTHOR = 'Unknown Author'
+AUTHOR_SORT = 'Author, Unknown'
+# Calibre's internal representation of an undefined date.
+UNDEFINED_DATE = '0101-01-01 00:00:00+00:00'
+# Length limit for author and title directory names. Calibre's own limit on Windows.
+PATH_LIMIT = 40
+# Characters not allowed in directory names, on Windows at least.
+PATH_INVALID_CHARS_RE = re.compile(r'[\\/:*?"<>|]')
+# Empty line, possibly containing whitespace, before a line starting with a book entry number 
+# like "123. ".
+ENTRY_SPLIT_RE = re.compile(r"(?m)^[^\S\n]*\n(?=[1-9][0-9]*\. )")
+# Fields of a book entry. Whitespace after an optional field is matched inside that field's group, 
+# so that no two adjacent \s* can split the same whitespace between them in many ways when 
+# backtracking.
+ENTRY_RE = re.compile(r'''
+    (?P<id>^[1-9][0-9]*)\.                     # book id like in "123. "
+    \s*
+    \*\*
+    (\[)?                                        # Group 2, set for a title with link.
+    (?P<title>(?(2) [^\]]* | [^*]* ))            # Title. W/o link (rarely used) may contain "]".
+    (?(2) \]\((?P<link>[^\n]+)\) )               # Link, if the title is in "[…]".
+    [^\n]\*\*
+    \s*
+    (?: (?P<year>[0-9]{4,4})\. \s* )?            # Optional publishing year.
+    (?: (?P<pages>[0-9]+)\s+pages\. \s* )?       # Optional page count.
+    (?P<description>.*[^\n])?                    # Optional description. W/o potential final \n.
+    ''',
+    # Enable readable regexes as seen above, see https://stackoverflow.com/q/8006551 . And make "." 
+    # match even \n, as the description spans multiple lines. The title uses [^\n] instead.
+    re.VERBOSE | re.DOTALL
+)
+# Anything that could make Markdown render a text other than as one plain paragraph: inline markup 
+# characters and HTML, line-level markup like headings, lists or quotes, indentation, blank lines, 
+# tabs (which Markdown expands) and trailing whitespace.
+MARKDOWN_SYNTAX_RE = re.compile(r'[\t\\`*_\[\]<>&]|^\s|^(?:[#>+=-]|[0-9]+\.)|\s$', re.MULTILINE)
+# One Markdown converter for all descriptions, as creating one compiles all its regexes again.
+MARKDOWN = markdown.Markdown()
+# Default title sort regex of Calibre Web.
+TITLE_SORT_RE = re.compile(
+    r'^(A|The|An|Der|Die|Das|Den|Ein|Eine|Einen|Dem|Des|Einem|Eines)\s+', re.IGNORECASE
+)
+
+
+def iter_entries(text):
+    """Split a book list into its entries, one at a time.
+
+    Each entry starts with its number, after an empty line that may contain whitespace. Splitting 
+    with one regex is much faster than scanning the text line by line in Python. Yielding the 
+    entries rather than returning a list allows to parse each one right away, without keeping all 
+    of them.
+    """
+    start = 0
+    for separator in ENTRY_SPLIT_RE.finditer(text):
+        yield text[start:separator.start()]
+        start = separator.end()
+    yield text[start:]
+
+
+def calibre_title(title, entry_id):
     """Catch and log errors related to the title field, and provide the title in a safe format."""
-    if dict['title'] is not None:
-        return ['--title', dict['title']]
+    if title is not None:
+        return title
     else:
-        log.error(f'No title in book record with ID {dict["id"]}')
-        # ['--title', ''] would also work, but ['--title', None] would crash the subprocess.run 
-        # call to calibredb later.
-        return []
+        log.error(f'No title in book record with ID {entry_id}')
+        # Same default title as Calibre itself uses, as the books.title column may not be NULL.
+        return 'Unknown'
 
 
-def calibredb_pubdate_args(dict):
-    """Render a publication date in the yyyy-mm-dd format expected by calibredb."""
-    if dict['year'] is not None:
-        return ['--field', f'pubdate:{dict["year"]}-01-01']
+def calibre_pubdate(year):
+    """Render a publication date in the timestamp format used in the Calibre database."""
+    if year is not None:
+        return f'{year}-01-01 00:00:00+00:00'
     else:
-        # Returning an empty list so that no "--field pubdate:…" will be included in the 
-        # calibredb call at all, keeping the value "Undefined", which is internally represented as 
-        # 0101-01-01T01:00:00+01:00. A literal of "" would have the same effect.
-        return []
+        # Calibre's way to represent the "Undefined" publication date.
+        return UNDEFINED_DATE
 
 
-def calibredb_pages_args(dict):
-    """Render a page count in the format expected by calibredb."""
-    if dict['pages'] is not None:
-        return ['--field', f'#pages:{dict["pages"]}']
+def calibre_pages(pages):
+    """Render a page count in the format expected by the #pages custom column."""
+    if pages is not None:
+        return int(pages)
     else:
-        return []
+        return None
 
 
-def calibredb_link_args(dict):
-    """Render the Calibre link field name and value appropriate for the link we have."""
-    if dict['link'] is None:
-        return []
-    elif dict['link'].endswith('.pdf'):
-        return ['--field', f'#link_pdf:{dict["link"]}']
-    elif dict['link'].endswith('.epub'):
-        return ['--field', f'#link_epub:{dict["link"]}']
+def calibre_link_field(link):
+    """Determine the Calibre link custom column label and value appropriate for the link we have."""
+    if link is None:
+        return None
+
+    # Only the end of the link matters, and links to "….PDF" files are PDF links as well.
+    suffix = link[-5:].lower()
+    if suffix.endswith('.pdf'):
+        label = 'link_pdf'
+    elif suffix.endswith('.epub'):
+        label = 'link_epub'
     else:
-        return ['--field', f'#link_meta:{dict["link"]}']
+        label = 'link_meta'
+    return (label, link)
+
 
+def calibre_comments(description):
+    """Render additional metadata into HTML for the comments field."""
+    if description is None:
+        return None
 
-def calibredb_comments_args(dict):
-    """Provide calibredb arguments to render additional metadata into the comments field."""
-    if dict['description'] is not None:
-        description_html = markdown.markdown(dict['description'])
-        return ['--field', f'comments:<div>{description_html}</div>']
+    if MARKDOWN_SYNTAX_RE.search(description):
+        MARKDOWN.reset() # Clear state left over from converting the last description.
+        description_html = MARKDOWN.convert(description)
     else:
-        return []
+        # Plain prose, so skip the slow Markdown conversion. Same result as Markdown would render.
+        description_html = f'<p>{description}</p>'
+    return f'<div>{description_html}</div>'
 
 
-#################### MAIN SCRIPT START ####################
+def title_sort(title):
+    """Calibre's title sort function, needed by the triggers of the books table.
 
-# Configure logging to stdout. See: https://stackoverflow.com/a/28194953
-logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
-log = logging.getLogger(__name__)
+    Mirrors the one Calibre Web registers in cps/db.py, using its default title regex.
+    """
+    match = TITLE_SORT_RE.search(title)
+    if match:
+        prep = match.group(1)
+        title = title[len(prep):] + ', ' + prep
+    return title.strip()
 
-args = docopt(__doc__)
 
-#### (1) Read the input file into a list of lines.
-with open(args['BOOKLIST_FILE'], 'r') as booklist_file: booklist_lines = booklist_file.readlines()
+def calibre_path_component(value):
+    """Render a string into a directory name component the way Calibre does, roughly."""
+    value = unicodedata.normalize('NFKD', value).encode('ascii', 'ignore').decode('ascii')
+    value = PATH_INVALID_CHARS_RE.sub('_', value).strip()
+    return value[:PATH_LIMIT].strip() or 'Unknown'
+
+
+def calibre_path(author_dir, title, calibre_id):
+    """Provide the book directory path relative to the library, as Calibre would create it."""
+    return f'{author_dir}/{calibre_path_component(title)} ({calibre_id})'
+
 
-#### (2)  Convert the list of lines into a list of book entries that we can parse later.
-last_line_empty = False
-booklist_entries = []
-entry = ''
-for line in booklist_lines:
-    entry_number_match = re.search(r"(^[1-9]+[0-9]*)\. ", line)
+def create_book_dir(path):
+    """Create the directory of a book record in the Calibre library, if it does not exist yet."""
+    os.makedirs(os.path.join(args['CALIBREDB_DIR'], path), exist_ok=True)
 
-    if last_line_empty and entry_number_match:
-        if args['--verbose']: log.info("Found booklist entry: %s", entry)
-        booklist_entries.append(entry)
 
-        entry = line # Start aggregating the next entry.
+def custom_column_tables(db_connection, label):
+    """Determine the tables that store a custom column's values in the Calibre database.
+
+    Returns a tuple (value_table, link_table) where link_table is None for custom columns that are
+    not normalized, or None if there is no custom column with that label.
+    """
+    row = db_connection.execute(
+        'SELECT id, normalized FROM custom_columns WHERE label = ?', (label,)
+    ).fetchone()
+    if row is None:
+        log.error(f'No custom column #{label} in the Calibre database')
+        return None
+
+    column_id, normalized = row
+    if normalized:
+        return (f'custom_column_{column_id}', f'books_custom_column_{column_id}_link')
     else:
-        entry += line
+        return (f'custom_column_{column_id}', None)
+
 
-    last_line_empty = (line == "\n")
-# Add last entry in the file.
-if args['--verbose']: log.info("Found booklist final entry: %s", entry)
-booklist_entries.append(entry)
+def insert_custom_column_values(db_connection, label, rows):
+    """Insert (calibre_id, value) rows into the tables of a custom column in one batch."""
+    # No need to look up the column, or to require it in the library, if no book has such a value.
+    if not rows:
+        return
+
+    tables = custom_column_tables(db_connection, label)
+    if tables is None:
+        return
+    value_table, link_table = tables
+
+    if link_table is None:
+        db_connection.executemany(f'INSERT INTO {value_table} (book, value) VALUES (?, ?)', rows)
+    else:
+        # Normalized columns store every distinct value once and link books to it.
+        db_connection.executemany(
+            f'INSERT OR IGNORE INTO {value_table} (value) VALUES (?)',
+            [(value,) for calibre_id, value in rows]
+        )
+        db_connection.executemany(
+            f'INSERT INTO {link_table} (book, value) '
+            f'SELECT ?, id FROM {value_table} WHERE value = ?',
+            rows
+        )
 
-log.info("Booklist entries found: %s", len(booklist_entries))
 
-#### (3) Parse the book list entries one by one and extract the information into a list of dicts.
+#################### MAIN SCRIPT START ####################
+
+# Configure logging to stdout. See: https://stackoverflow.com/a/28194953
+logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
+log = logging.getLogger(__name__)
+
+args = docopt(__doc__)
+
+#### (1) Read the input file into one string.
+with open(args['BOOKLIST_FILE'], 'r') as booklist_file: booklist_text = booklist_file.read()
+
+#### (2) Split the text into book entries and parse them one by one into a list of dicts.
 booklist_dicts = []
-entry_regex = re.compile(r'''
-    (?P<id>^[1-9]+[0-9]*)\.                     # book id like in "123. "
-    \s*
-    (?:
-        (?: \*\*\[(?P<title1>[^\]]*)\]\((?P<link>.+)\).\*\* ) |  # Title with link.
-        (?: \*\*(?P<title2>[^*]*).\*\* )                         # Title without link, rarely used.
-    )
-    \s*
-    (?: (?P<year>[0-9]{4,4})\.)?                 # Optional publishing year.
-    \s*
-    (?: (?P<pages>[0-9]+)\s+pages\.)?            # Optional page count.
-    \s*
-    (?s:                                         # ?s to make "." match even \n in tje description.
-        (?P<description>.*[^\n])                 # Description. W/o potential final \n.
-    )?                                           # Description is optional.
-    ''',
-    re.VERBOSE # Enable readable regexe as seen above; see https://stackoverflow.com/q/8006551
-)
-for entry in booklist_entries:
-    match = entry_regex.search(entry)
+entry_count = 0
+for entry in iter_entries(booklist_text):
+    if not entry.strip():
+        continue
+    entry_count += 1
+    if args['--verbose']: log.info("Found booklist entry: %s", entry)
+
+    match = ENTRY_RE.match(entry)
 
     if not match:
         log.info("Booklist entry could not be parsed: %s", entry)
         continue
     
-    dict = match.groupdict()
-
-    # Normalize the dict, cleaning up the title1/2 mess left over from regex processing.
-    dict['title'] = dict['title1'] if dict['title1'] is not None else dict['title2']
-    dict.pop('title1', None)
-    dict.pop('title2', None)
+    rec = match.groupdict()
 
     if args['--verbose']:
-        log.info("Creating booklist dict: %s", dict)
+        log.info("Creating booklist dict: %s", rec)
 
-    booklist_dicts.append(dict)
+    booklist_dicts.append(rec)
     # See: https://docs.python.org/3/library/re.html#re.Match.groupdict
 
+log.info("Booklist entries found: %s", entry_count)
 log.info("Booklist dicts created: %s", len(booklist_dicts))
 
-#### (4) Add the book records to the Calibre database.
-for dict in booklist_dicts:
-    log.info("Import book record with ID %s", dict['id'])
+# Turn the list of dicts into one list per field, so that the rows for each database table below 
+# can be built from just the fields they need, without looking them up in every book's dict again.
+entry_ids, titles, links, years, page_counts, descriptions = (
+    [rec[field] for rec in booklist_dicts]
+    for field in ('id', 'title', 'link', 'year', 'pages', 'description')
+)
 
-    # Add the main book record to Calibre.
-    # Docs: https://docs.python.org/3/library/subprocess.html#using-the-subprocess-module
-    run_result = subprocess.run(
+#### (3) Add the book records to the Calibre database.
+# Writing into metadata.db directly, as starting one calibredb process for every database access
+# is really slow. Everything happens in a single transaction, so also only one commit to disk.
+# Calibre must not run meanwhile, as it would not notice the changes.
+db_path = os.path.join(args['CALIBREDB_DIR'], 'metadata.db')
+# sqlite3.connect() would create an empty database file where there is none.
+if not os.path.isfile(db_path):
+    log.error(f'No Calibre database found at {db_path}')
+    sys.exit(1)
+db_connection = sqlite3.connect(
+    db_path,
+    isolation_level = None # Manage transactions explicitly with BEGIN and COMMIT below.
+)
+# Functions that Calibre normally provides to the triggers of its database.
+db_connection.create_function('title_sort', 1, title_sort)
+db_connection.create_function('uuid4', 0, lambda: str(uuid.uuid4()))
+
+# Trade durability for speed during the import, as it can simply be re-run after a crash. A crash 
+# may however corrupt the database, so better make a backup of the library beforehand.
+original_synchronous = db_connection.execute('PRAGMA synchronous').fetchone()[0]
+original_journal_mode = db_connection.execute('PRAGMA journal_mode').fetchone()[0]
+db_connection.execute('PRAGMA synchronous = OFF')
+db_connection.execute('PRAGMA journal_mode = MEMORY')
+db_connection.execute('PRAGMA temp_store = MEMORY')
+db_connection.execute('PRAGMA cache_size = -65536') # Negative means in KiB, so 64 MiB.
+
+try:
+    # IMMEDIATE takes the write lock right away, so no other writer can interfere, which the 
+    # upfront ID assignment below relies on.
+    db_connection.execute('BEGIN IMMEDIATE')
+
+    author_row = db_connection.execute(
+        'SELECT id FROM authors WHERE name = ?', (AUTHOR,)
+    ).fetchone()
+    if author_row is not None:
+        author_id = author_row[0]
+    else:
+        author_id = db_connection.execute(
+            'INSERT INTO authors (name, sort) VALUES (?, ?)', (AUTHOR, AUTHOR_SORT)
+        ).lastrowid
+
+    # All books go into the directory of the same author.
+    author_dir = calibre_path_component(AUTHOR)
+
+    # Assign the IDs of the new books upfront, so that each book needs only one INSERT statement 
+    # that includes its ID-based path, and all of them can run via executemany(). With the 
+    # write lock held, nobody else can take these IDs. As the books table uses AUTOINCREMENT, 
+    # sqlite_sequence holds the largest ID ever used.
+    last_calibre_id = db_connection.execute(
+        "SELECT COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'books'), 0)"
+    ).fetchone()[0]
+
+    now = datetime.now(timezone.utc).isoformat(sep=' ')
+    calibre_ids = range(last_calibre_id + 1, last_calibre_id + 1 + len(booklist_dicts))
+    for entry_id, calibre_id in zip(entry_ids, calibre_ids):
+        log.info("Import book record with ID %s as calibre_id = %s", entry_id, calibre_id)
+    titles = list(map(calibre_title, titles, entry_ids))
+    calibre_paths = [
+        calibre_path(author_dir, title, calibre_id)
+        for title, calibre_id in zip(titles, calibre_ids)
+    ]
+
+    # Add the book records, then additional metadata about the books, in one batch per table.
+    db_connection.executemany(
+        'INSERT INTO books (id, title, pubdate, author_sort, path, timestamp, last_modified) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?)',
+        zip(
+            calibre_ids, titles, map(calibre_pubdate, years), repeat(AUTHOR_SORT), calibre_paths,
+            repeat(now), repeat(now)
+        )
+    )
+    db_connection.executemany(
+        'INSERT INTO books_authors_link (book, author) VALUES (?, ?)',
+        zip(calibre_ids, repeat(author_id))
+    )
+    db_connection.executemany(
+        'INSERT INTO comments (book, text) VALUES (?, ?)',
         [
-            'calibredb', 
-            '--library-path', args['CALIBREDB_DIR'],
-            'add',
-            '--empty',
-            *calibredb_title_args(dict),
-            # Not setting the author would default to "Unknown", but we want "Unknown Author".
-            '--authors', 'Unknown Author'
-        ], 
-        capture_output = True,
-        text = True # Converts captured output to string rather than returning "bytes-like object".
+            (calibre_id, comments)
+            for calibre_id, comments in zip(calibre_ids, map(calibre_comments, descriptions))
+            if comments is not None
+        ]
     )
-    dict['calibre_id'] = re.findall(r'Added book ids:\s+([0-9]+)', run_result.stdout)[0]
-    log.info("Book added to Calibre. calibre_id = %s", dict['calibre_id'])
-
-    # Add additional metadata about the book to Calibre.
-    run_result = subprocess.run(
+    insert_custom_column_values(
+        db_connection, 'pages',
         [
-            'calibredb',
-            '--library-path', args['CALIBREDB_DIR'],
-            'set_metadata',
-            *calibredb_pubdate_args(dict),
-            *calibredb_pages_args(dict),
-            *calibredb_link_args(dict),
-            *calibredb_comments_args(dict),
-            dict['calibre_id']
+            (calibre_id, pages)
+            for calibre_id, pages in zip(calibre_ids, map(calibre_pages, page_counts))
+            if pages is not None
         ]
     )
+    link_rows = {'link_pdf': [], 'link_epub': [], 'link_meta': []}
+    for calibre_id, link_field in zip(calibre_ids, map(calibre_link_field, links)):
+        if link_field is not None:
+            link_rows[link_field[0]].append((calibre_id, link_field[1]))
+    for label, rows in link_rows.items():
+        insert_custom_column_values(db_connection, label, rows)
+
+    db_connection.execute('COMMIT')
+finally:
+    # Without the COMMIT above, closing discards all changes, so nothing is imported half-way. 
+    # Pragmas may not be changed inside that still open transaction, and closing resets them anyway.
+    if not db_connection.in_transaction:
+        db_connection.execute(f'PRAGMA journal_mode = {original_journal_mode}')
+        db_connection.execute(f'PRAGMA synchronous = {original_synchronous}')
+    db_connection.close()
+
+# Calibre creates a directory for every book, even if it has no files yet. This waits for the file 
+# system rather than the CPU, which can take long for libraries on network storage, so several 
+# threads create directories at once. list() makes errors in the threads surface here.
+with ThreadPoolExecutor(max_workers = 4) as executor:
+    list(executor.map(create_book_dir, calibre_paths))